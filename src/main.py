@@ -1,29 +1,119 @@
 # tinyagent_deep_research.py - tools for tinyagent to make a deep research like, flow for query
 
 import os
-import math
+import re
+import random
 import asyncio
+import hashlib
 import logging
-from typing import List, Dict
+from collections import deque
+from functools import lru_cache, partial
+from typing import Any, Awaitable, Callable, Iterable, List, Dict, Tuple
+import diskcache
+import hnswlib
+import httpx
+import jiter
+import numpy as np
+import orjson
+import tiktoken
 from dotenv import load_dotenv
 from tinyagent.decorators import tool
 from tinyagent.agent import tiny_agent
 from pydantic import BaseModel, Field, ValidationError
-from firecrawl import FirecrawlApp
-from openai import AsyncOpenAI
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from openai import AsyncOpenAI, APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+
 
 # env and config
 load_dotenv()
 
-LLM_MODEL = "gpt-4o-mini"
+DEFAULT_LLM = "gpt-4o-mini"
+# query planning needs better reasoning, digesting is bulk summarization a cheaper model handles
+PLAN_MODEL = os.getenv("PLAN_MODEL", DEFAULT_LLM)
+DIGEST_MODEL = os.getenv("DIGEST_MODEL", DEFAULT_LLM)
+EMBED_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+EMBED_BATCH_SIZE = 256
+# the embedding model takes 8192 tokens, this prefix stays under it even at 2 tokens per char
+EMBED_MAX_CHARS = 4_000
+# one request may carry 300k tokens in total, keep each batch well under it
+EMBED_BATCH_MAX_CHARS = 200_000
+EMBED_BATCH_WINDOW = 0.02
+MAX_TOKENS_PER_DOC = 6_000
 CONCURRENCY = 2
+RETRY_ATTEMPTS = 4
+# upper bound on any single retry sleep, however long the server asks us to wait
+RETRY_MAX_DELAY = 30
+# optional local cross-encoder rerank of search passages before digesting (needs sentence-transformers)
+RERANK = os.getenv("RERANK") == "1"
+RERANK_MODEL = "BAAI/bge-reranker-v2-m3"
+RERANK_TOP_K = 4
+PASSAGE_TOKENS = 512
+CACHE_DIR = os.path.expanduser(os.getenv("TINYAGENT_DS_CACHE_DIR", "~/.cache/tinyagent_ds"))
+CACHE_TTL = 7 * 24 * 3600
+CACHE_SIZE_LIMIT = 2 ** 30
+# searched queries digested per LLM call, keeps a wide level inside the context window
+DIGEST_BATCH_SIZE = 6
+# how long a ready query waits for more to share a batch search; small next to a search round trip
+SEARCH_BATCH_WINDOW = 0.2
+
+FIRECRAWL_BASE_URL = os.getenv("FIRECRAWL_BASE_URL") or "https://api.firecrawl.dev"
+
+# one long-lived HTTP/2 pool per service and event loop, sized for the gather fan-out
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=64, max_connections=128)
+HTTP_TIMEOUT = httpx.Timeout(connect=5, read=120, write=30, pool=5)
+
+
+def _new_openai_client() -> AsyncOpenAI:
+    # retries are handled by _with_retry so they aren't stacked on the SDK's own
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_KEY"),
+        max_retries=0,
+        timeout=HTTP_TIMEOUT,
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT),
+    )
+
+
+def _new_firecrawl_http() -> httpx.AsyncClient:
+    # firecrawl's SDK search is synchronous, talk to the REST API directly so it doesn't block the loop
+    return httpx.AsyncClient(
+        base_url=FIRECRAWL_BASE_URL,
+        headers={"Authorization": f"Bearer {os.getenv('FIRECRAWL_KEY', '')}"},
+        http2=True,
+        timeout=HTTP_TIMEOUT,
+        limits=HTTP_LIMITS,
+    )
+
+
+# (loop, {name: object}) for the loop that last asked
+_loop_state: Tuple[asyncio.AbstractEventLoop | None, Dict[str, Any]] = (None, {})
+
+
+def _loop_local(name: str, factory: Callable[[], Any]) -> Any:
+    """
+    Return the running loop's instance of a shared object, building it on first use.
+    Pooled connections and asyncio primitives are bound to the loop that first
+    uses them, so a later asyncio.run gets fresh ones instead of dead ones.
+    """
+    global _loop_state
+    loop = asyncio.get_running_loop()
+    if _loop_state[0] is not loop:
+        _loop_state = (loop, {})
+    objects = _loop_state[1]
+    if name not in objects:
+        objects[name] = factory()
+    return objects[name]
+
+
+def openai_client() -> AsyncOpenAI:
+    return _loop_local("openai", _new_openai_client)
+
+
+def firecrawl_http() -> httpx.AsyncClient:
+    return _loop_local("firecrawl", _new_firecrawl_http)
 
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_KEY"))
-firecrawl = FirecrawlApp(
-    api_key=os.getenv("FIRECRAWL_KEY", ""),
-    api_url=os.getenv("FIRECRAWL_BASE_URL", None)
-)
+
+# request body fragment shared by every search, built once
+_SCRAPE_OPTS = {"formats": ["markdown"]}
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 log = logging.getLogger("tinyagent_deep_research")
@@ -44,142 +134,760 @@ class SearchDigest(BaseModel):
     learnings: List[str]
     follow_up_questions: List[str]
 
+
+class ItemDigest(SearchDigest):
+    id: int = Field(description="id of the <item> this digest is for")
+
+
+class DigestBatch(BaseModel):
+    digests: List[ItemDigest]
+
+# retries honoring the server's Retry-After
+
+
+def _is_retriable(e: Exception) -> bool:
+    if isinstance(e, (RateLimitError, APIConnectionError, InternalServerError, httpx.TransportError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+def _retry_after(e: Exception) -> float | None:
+    response = getattr(e, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def _with_retry(coro_fn: Callable[[], Awaitable[Any]], *, max_attempts: int = RETRY_ATTEMPTS) -> Any:
+    """
+    Await coro_fn(), retrying rate limits, 5xx and connection errors.
+    Sleeps for the server's Retry-After when given (at most RETRY_MAX_DELAY, else
+    1, 2, 4.. capped at 8s) plus jitter. Other client errors (400, 401, 422, ...) are raised at once.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return await coro_fn()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not _is_retriable(e):
+                raise
+            delay = _retry_after(e)
+            delay = min(2 ** attempt, 8) if delay is None else min(delay, RETRY_MAX_DELAY)
+            delay += random.uniform(0, 0.25 * 2 ** attempt)
+            log.warning(f"[Warning] {type(e).__name__} (attempt {attempt + 1}/{max_attempts}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# semantic cache for llm_complete
+
+
+class SemanticCache:
+    """
+    Reuse structured LLM responses for prompts that are close in embedding space.
+    Entries are bucketed by (schema name, system prompt, model, caller scope). Each bucket is an
+    HNSW index over the prompt embeddings, so a lookup is an approximate nearest
+    neighbour query rather than a scan over every cached vector. Most buckets hold
+    a single entry, so indexes start small and double as they fill.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, initial_capacity: int = 16):
+        self.threshold = threshold
+        self.initial_capacity = initial_capacity
+        self._indexes: Dict[tuple, hnswlib.Index] = {}
+        self._dumps: Dict[tuple, List[dict]] = {}
+
+    def get(self, bucket: tuple, vec: np.ndarray) -> dict | None:
+        index = self._indexes.get(bucket)
+        if index is None or index.get_current_count() == 0:
+            return None
+        labels, distances = index.knn_query(vec, k=1)
+        # cosine space reports 1 - similarity
+        if 1.0 - distances[0][0] >= self.threshold:
+            return self._dumps[bucket][labels[0][0]]
+        return None
+
+    def put(self, bucket: tuple, vec: np.ndarray, dump: dict) -> None:
+        index = self._indexes.get(bucket)
+        if index is None:
+            index = hnswlib.Index(space="cosine", dim=vec.shape[0])
+            index.init_index(max_elements=self.initial_capacity)
+            self._indexes[bucket] = index
+            self._dumps[bucket] = []
+        dumps = self._dumps[bucket]
+        if len(dumps) == index.get_max_elements():
+            index.resize_index(2 * len(dumps))
+        index.add_items(vec[np.newaxis], [len(dumps)])
+        dumps.append(dump)
+
+
+semantic_cache = SemanticCache()
+
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent embed() calls into one embeddings request. A background
+    task takes queued prompts, waits up to `window` seconds for more (at most
+    `max_batch`), and sends them as array inputs of at most `max_chars` in total.
+    A request rejected as bad is split in half and retried, so one bad prompt only
+    fails itself; other errors (auth, exhausted rate limits) fail the whole batch.
+    """
+
+    def __init__(self, max_batch: int = EMBED_BATCH_SIZE, window: float = EMBED_BATCH_WINDOW,
+                 max_chars: int = EMBED_BATCH_MAX_CHARS):
+        self.max_batch = max_batch
+        self.window = window
+        self.max_chars = max_chars
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> np.ndarray:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, fut))
+        return await fut
+
+    async def aclose(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch and (timeout := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # send in the background so the next window fills while this one is in flight
+            for chunk in self._split(batch):
+                task = asyncio.create_task(self._flush(chunk))
+                self._flushes.add(task)
+                task.add_done_callback(self._flushes.discard)
+
+    def _split(self, batch: List[Tuple[str, asyncio.Future]]) -> Iterable[List[Tuple[str, asyncio.Future]]]:
+        chunk, size = [], 0
+        for item in batch:
+            if chunk and size + len(item[0]) > self.max_chars:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(item)
+            size += len(item[0])
+        yield chunk
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            res = await _with_retry(lambda: openai_client().embeddings.create(
+                model=EMBED_MODEL, input=[text for text, _ in batch]))
+        except Exception as e:
+            if isinstance(e, BadRequestError) and len(batch) > 1:
+                mid = len(batch) // 2
+                await asyncio.gather(self._flush(batch[:mid]), self._flush(batch[mid:]))
+                return
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        vecs = np.asarray([d.embedding for d in sorted(res.data, key=lambda d: d.index)], dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs /= np.where(norms == 0, 1, norms)
+        for (_, fut), vec in zip(batch, vecs):
+            if not fut.done():
+                fut.set_result(vec)
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+async def embed(text: str) -> np.ndarray:
+    """Embed a bounded prefix of text (batched with concurrent callers), L2-normalized."""
+    return await embedding_batcher.embed(text[:EMBED_MAX_CHARS])
+
+# exact-match memo, concurrent identical calls share one in-flight request
+
+
+_llm_cache: Dict[Tuple[str, str, str], BaseModel] = {}
+_fc_cache: Dict[Tuple[str, int], List[dict]] = {}
+_inflight: Dict[tuple, asyncio.Future] = {}
+_cache_lock = asyncio.Lock()
+
+
+def _settle(cache: dict, key: tuple, inflight_key: tuple, task: asyncio.Future) -> None:
+    _inflight.pop(inflight_key, None)
+    # .exception() also marks a failure as retrieved when every caller was cancelled
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        cache[key] = task.result()
+
+
+async def _memoized(cache: dict, key: tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Return cache[key], or run fetch() once and store its result.
+    Callers racing on the same key await the same task; it is shielded so
+    cancelling one caller does not cancel the request for the others.
+    """
+    inflight_key = (id(cache), key)
+    async with _cache_lock:
+        if key in cache:
+            return cache[key]
+        task = _inflight.get(inflight_key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            task.add_done_callback(partial(_settle, cache, key, inflight_key))
+            _inflight[inflight_key] = task
+    return await asyncio.shield(task)
+
+# persistent cache so warm re-runs replay LLM and search results from disk
+
+
+disk_cache = diskcache.Cache(CACHE_DIR, size_limit=CACHE_SIZE_LIMIT)
+
+
+def _disk_key(*parts: str) -> str:
+    return hashlib.blake2b("\x00".join(parts).encode()).hexdigest()
+
+# prompt templates, static instructions first so provider-side prefix caching covers as much as possible
+
+
+_GEN_SYS = "You're a research assistant that generates focused search queries. Consider previous learnings and create distinct queries that will uncover new information."
+_GEN_TMPL = (
+    "Generate focused search queries that will help deepen understanding of the topic. "
+    "Each query should have a clear research goal. Please respond with a JSON object containing a list of queries, "
+    "where each query is a JSON object with 'query' and 'research_goal' properties.\n\n"
+    "Number of queries: {n}\n\n"
+    "Topic: {topic}\n\n"
+    "Previous findings:\n{learnings}"
+)
+
+_DIGEST_SYS = "You're a research analyst. Extract insights and identify knowledge gaps from search results."
+_DIGEST_TMPL = (
+    "Analyze the search results for each item below. "
+    "For every item produce {max_learn} key learnings and {max_follow} follow-up questions, "
+    "and set the digest's id to the item's id. "
+    "If an item's content is unusable, emit an empty digest for it so there is one digest per item.\n\n"
+    "Number of items: {count}\n\n"
+    "Content:\n{blocks}"
+)
+
 # tooling for tinyagent
 
 
-tool_usage_log = []
+_WHITESPACE = re.compile(r"\s+")
 
-@tool
-@retry(wait=wait_random_exponential(min=2, max=8), stop=stop_after_attempt(4))
-async def llm_complete(system: str, prompt: str, schema: type[BaseModel]) -> BaseModel:
-    entry = f"llm_complete(schema={schema})"
-    print(f"[TOOL] {entry}")
+
+def _dedupe_learnings(learnings: Iterable[str]) -> List[str]:
+    """
+    Sorted learnings with near-duplicates dropped: entries that differ only in
+    case, whitespace or a trailing period collapse to the first one.
+    """
+    unique: Dict[str, str] = {}
+    for learning in sorted(learnings):
+        unique.setdefault(_WHITESPACE.sub(" ", learning).strip().rstrip(".").casefold(), learning)
+    return list(unique.values())
+
+
+# bounded so long runs don't grow it forever
+tool_usage_log = deque(maxlen=10_000)
+
+
+def _record_tool(entry: str) -> None:
     tool_usage_log.append(entry)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"[TOOL] {entry}")
+
+
+@tool
+async def llm_complete(system: str, prompt: str, schema: type[BaseModel], model: str | None = None,
+                       on_partial: Callable[[Any], None] | None = None,
+                       semantic: Tuple[Any, str] | None = None) -> BaseModel:
     """
     Hit the LLM using the .responses.parse() method for structured output.
     Returns the Pydantic model *instance*.
+    Exact repeats are served from the in-process memo. semantic=(scope, text)
+    opts in to the semantic cache: an earlier answer with the same schema,
+    system, model and scope whose text embeds close to this one is reused.
+    Without it the semantic cache is skipped.
+    With on_partial the response is streamed instead, and on_partial gets the
+    partially parsed JSON after every delta. Cache hits don't call it.
     """
-    response_obj = await openai_client.responses.parse(
-        model=LLM_MODEL,
-        input=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": prompt},
-        ],
-        text_format=schema,
-    )
-    data_obj = response_obj.output_parsed
+    model = model or DEFAULT_LLM
+    entry = f"llm_complete(schema={schema}, model={model})"
+    _record_tool(entry)
+    key = (hashlib.blake2b((system + "\x00" + prompt).encode()).hexdigest(), schema.__name__, model)
+    data_obj = await _memoized(_llm_cache, key, lambda: _llm_fetch(system, prompt, schema, model, on_partial, semantic))
+    return data_obj.model_copy(deep=True) if data_obj is not None else None
+
+
+async def _llm_request(system: str, prompt: str, schema: type[BaseModel], model: str,
+                       on_partial: Callable[[Any], None] | None) -> BaseModel:
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt},
+    ]
+    if on_partial is None:
+        response_obj = await openai_client().responses.parse(model=model, input=messages, text_format=schema)
+        return response_obj.output_parsed
+
+    text = ""
+    async with openai_client().responses.stream(model=model, input=messages, text_format=schema) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                text += event.delta
+                try:
+                    # partial mode drops unfinished strings, so every value seen is complete
+                    on_partial(jiter.from_json(text.encode(), partial_mode=True))
+                except ValueError:
+                    pass
+        response_obj = await stream.get_final_response()
+    return response_obj.output_parsed
+
+
+async def _llm_fetch(system: str, prompt: str, schema: type[BaseModel], model: str,
+                     on_partial: Callable[[Any], None] | None = None,
+                     semantic: Tuple[Any, str] | None = None) -> BaseModel:
+    disk_key = _disk_key("llm", system, prompt, schema.__name__, model)
+    if (stored := disk_cache.get(disk_key)) is not None:
+        return schema.model_validate_json(stored)
+
+    vec = None
+    if semantic is not None:
+        scope, text = semantic
+        bucket = (schema.__name__, system, model, scope)
+        try:
+            vec = await embed(text)
+        except Exception as e:
+            # the cache is only a shortcut, a failed embedding must not fail the call
+            log.warning(f"[Warning] Embedding failed, skipping semantic cache: {e}")
+        if vec is not None and (cached := semantic_cache.get(bucket, vec)) is not None:
+            return schema.model_validate(cached)
+
+    data_obj = await _with_retry(lambda: _llm_request(system, prompt, schema, model, on_partial))
+    if data_obj is not None:
+        if vec is not None:
+            semantic_cache.put(bucket, vec, data_obj.model_dump())
+        disk_cache.set(disk_key, data_obj.model_dump_json(), expire=CACHE_TTL)
     return data_obj
 
 
 @tool
-async def generate_search_queries(topic: str, prev_learnings: List[str], n: int = 3) -> List[SearchQuery]:
+async def generate_search_queries(topic: str, prev_learnings: Iterable[str], n: int = 3,
+                                  on_query: Callable[[SearchQuery], None] | None = None) -> List[SearchQuery]:
+    """
+    Plan up to n search queries for topic. With on_query, the response is
+    streamed and each query is handed over as soon as it is complete, so its
+    search can start while the rest are still being generated.
+    """
     entry = f"generate_search_queries(topic={topic}, n={n})"
-    print(f"[TOOL] {entry}")
-    tool_usage_log.append(entry)
-    system = "You're a research assistant that generates focused search queries. Consider previous learnings and create distinct queries that will uncover new information."
-    prompt = f"""Topic: {topic}
-
-    Previous findings:
-    {chr(10).join(prev_learnings) if prev_learnings else 'No previous findings'}
-
-    Generate {n} focused search queries that will help deepen understanding of the topic. Each query should have a clear research goal. Please respond with a JSON object containing a list of queries, where each query is a JSON object with 'query' and 'research_goal' properties."""
+    _record_tool(entry)
+    # dedupe and sort so repeated findings don't cost tokens and equal sets give equal prompts
+    prev_learnings = _dedupe_learnings(prev_learnings)
+    learnings = "\n".join(prev_learnings) if prev_learnings else "No previous findings"
+    prompt = _GEN_TMPL.format_map({"n": n, "topic": topic, "learnings": learnings})
+    # reuse a plan only for a near-identical topic with the same count and findings
+    semantic = ((n, hashlib.blake2b(learnings.encode()).hexdigest()), topic)
+
+    emitted = 0
+
+    def emit_complete(doc: Any) -> None:
+        nonlocal emitted
+        items = doc.get("queries", []) if isinstance(doc, dict) else []
+        while (emitted < min(len(items), n) and isinstance(items[emitted], dict)
+               and {"query", "research_goal"} <= items[emitted].keys()):
+            on_query(SearchQuery.model_validate(items[emitted]))
+            emitted += 1
 
     batch = await llm_complete(
-        system=system,
+        system=_GEN_SYS,
         prompt=prompt,
-        schema=SearchBatch
+        schema=SearchBatch,
+        model=PLAN_MODEL,
+        on_partial=emit_complete if on_query else None,
+        semantic=semantic
     )
-    return batch.queries[:n]
+    queries = batch.queries[:n]
+    if on_query:
+        # cache hits and coalesced calls arrive here without any streamed items
+        for q in queries[emitted:]:
+            on_query(q)
+    return queries
 
 
 @tool
 async def firecrawl_search(q: str, k: int = 2) -> List[dict]:
     entry = f"firecrawl_search(q={q}, k={k})"
-    print(f"[TOOL] {entry}")
-    tool_usage_log.append(entry)
-    from firecrawl import ScrapeOptions
-    opts = ScrapeOptions(formats=["markdown"])
-    res = firecrawl.search(q, limit=k, scrape_options=opts)
+    _record_tool(entry)
+    results = await _memoized(_fc_cache, (q, k), lambda: _firecrawl_fetch(q, k))
+    return [dict(item) for item in results]
+
+
+# rough size of a token, used to cut by characters when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def _get_encoding() -> "tiktoken.Encoding | None":
+    """
+    Load the tokenizer on first use; tiktoken downloads the BPE file the first
+    time, so an offline run gets None and callers cut by characters instead.
+    """
+    try:
+        try:
+            # search markdown is only ever read by the digest model
+            return tiktoken.encoding_for_model(DIGEST_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        log.warning(f"[Warning] tiktoken encoding unavailable, clipping by characters: {e}")
+        return None
+
+
+# lines holding a lone table/heading/list marker, and runs of blank lines
+_BOILER_LINE = re.compile(r"(?m)^[ \t]*[|#*\-][ \t]*$")
+_BLANK_RUNS = re.compile(r"\n{3,}")
+
+
+def _clip_markdown(text: str) -> str:
+    """Strip layout-only lines and cut the page to MAX_TOKENS_PER_DOC tokens."""
+    # no token is anywhere near 10 chars on average, this just bounds the encode cost on huge pages
+    text = _BLANK_RUNS.sub("\n\n", _BOILER_LINE.sub("", text[:MAX_TOKENS_PER_DOC * 10]))
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:MAX_TOKENS_PER_DOC * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= MAX_TOKENS_PER_DOC:
+        return text
+    return encoding.decode(tokens[:MAX_TOKENS_PER_DOC])
+
+
+def _search_items(data: List[dict]) -> List[dict]:
     # Return both markdown and url for each result
-    return [{"markdown": item["markdown"][:25_000], "url": item.get("url")} for item in res.data if item.get("markdown") and item.get("url")]
+    return [{"markdown": _clip_markdown(item["markdown"]), "url": item.get("url")} for item in data if item.get("markdown") and item.get("url")]
+
+
+def _persist_search(q: str, k: int, results: List[dict]) -> None:
+    # an empty result is often transient, don't pin it for a week
+    if results:
+        disk_cache.set(_disk_key("search", q, str(k)), orjson.dumps(results), expire=CACHE_TTL)
+
+
+async def _firecrawl_post(path: str, payload: dict) -> httpx.Response:
+    async def post() -> httpx.Response:
+        r = await firecrawl_http().post(path, content=orjson.dumps(payload),
+                                      headers={"Content-Type": "application/json"})
+        r.raise_for_status()
+        return r
+    return await _with_retry(post)
+
+
+async def _firecrawl_fetch(q: str, k: int) -> List[dict]:
+    if (stored := disk_cache.get(_disk_key("search", q, str(k)))) is not None:
+        return orjson.loads(stored)
+    r = await _firecrawl_post("/v1/search", {"query": q, "limit": k, "scrapeOptions": _SCRAPE_OPTS})
+    results = _search_items(orjson.loads(r.content).get("data", []))
+    _persist_search(q, k, results)
+    return results
+
+
+def _batch_search_data(content: bytes, n: int) -> List[List[dict]]:
+    """Parse a batch search body, raising ValueError unless it holds one result list per query."""
+    body = orjson.loads(content)
+    data = body.get("data") if isinstance(body, dict) else None
+    if not (isinstance(data, list) and len(data) == n
+            and all(isinstance(res, list) and all(isinstance(item, dict) for item in res) for res in data)):
+        raise ValueError(f"unexpected batch search response shape for {n} queries")
+    return data
+
+
+_batch_search_available = True
 
 
 @tool
-async def digest_search_result(q: str, snippets: List[str], max_learn: int = 2, max_follow: int = 2) -> SearchDigest:
-    entry = f"digest_search_result(q={q}, snippets=[{len(snippets)} items], max_learn={max_learn}, max_follow={max_follow})"
-    print(f"[TOOL] {entry}")
-    tool_usage_log.append(entry)
-    joined = "\n".join(f"<content>{s}</content>" for s in snippets)
-    prompt = (
-        f"Analyze search results for: {q}\n"
-        f"Produce {max_learn} key learnings and {max_follow} follow-up questions.\n"
-        f"Content:\n{joined}"
+async def firecrawl_search_batch(qs: List[str], k: int = 2,
+                                 sem: asyncio.Semaphore | None = None) -> List[List[dict] | BaseException]:
+    """
+    Search several queries with one request to /v1/batch/search.
+    Queries already memoized or on disk are not resent. If the batch endpoint is missing,
+    or answers in an unexpected shape, falls back to concurrent /v1/search calls
+    (bounded by sem, shared by concurrent batches, or CONCURRENCY per call) and
+    stops trying the batch endpoint. Returns results or the exception per query.
+    """
+    global _batch_search_available
+    entry = f"firecrawl_search_batch(qs=[{len(qs)} queries], k={k})"
+    _record_tool(entry)
+    pending = [q for q in dict.fromkeys(qs)
+               if (q, k) not in _fc_cache and _disk_key("search", q, str(k)) not in disk_cache]
+    if _batch_search_available and len(pending) > 1:
+        try:
+            r = await _firecrawl_post(
+                "/v1/batch/search",
+                {"queries": pending, "limit": k, "scrapeOptions": _SCRAPE_OPTS},
+            )
+            # data holds one result list per query, in request order
+            for q, data in zip(pending, _batch_search_data(r.content, len(pending))):
+                _fc_cache[(q, k)] = results = _search_items(data)
+                _persist_search(q, k, results)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (404, 405):
+                log.info("Firecrawl batch search unavailable, using per-query search")
+                _batch_search_available = False
+            else:
+                log.warning(f"[Warning] Firecrawl batch search failed ({e.response.status_code}), using per-query search")
+        except httpx.HTTPError as e:
+            log.warning(f"[Warning] Firecrawl batch search failed ({e}), using per-query search")
+        except ValueError as e:
+            # a 200 with a body we can't read: this endpoint speaks another dialect, stop using it
+            log.warning(f"[Warning] Firecrawl batch search returned an unreadable body ({e}), using per-query search")
+            _batch_search_available = False
+
+    # anything the batch answered is now a memo hit
+    sem = sem or asyncio.Semaphore(CONCURRENCY)
+
+    async def one(q: str) -> List[dict]:
+        async with sem:
+            return await firecrawl_search(q, k)
+
+    return await asyncio.gather(*(one(q) for q in qs), return_exceptions=True)
+
+
+_reranker = None
+
+
+async def _get_reranker():
+    global _reranker
+    async with _loop_local("reranker_lock", asyncio.Lock):
+        if _reranker is None:
+            from sentence_transformers import CrossEncoder
+            _reranker = await asyncio.to_thread(CrossEncoder, RERANK_MODEL)
+    return _reranker
+
+
+def _passages(text: str) -> List[str]:
+    encoding = _get_encoding()
+    if encoding is None:
+        size = PASSAGE_TOKENS * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + PASSAGE_TOKENS]) for i in range(0, len(tokens), PASSAGE_TOKENS)]
+
+
+@tool
+async def rerank_snippets(q: str, snippets: List[str], top_k: int = RERANK_TOP_K) -> List[str]:
+    """
+    Split snippets into ~PASSAGE_TOKENS passages and keep the top_k most relevant
+    to q according to the cross-encoder. Scoring runs in a worker thread.
+    """
+    entry = f"rerank_snippets(q={q}, snippets=[{len(snippets)} items], top_k={top_k})"
+    _record_tool(entry)
+    passages = [p for s in snippets for p in _passages(s)]
+    if len(passages) <= top_k:
+        return passages
+    model = await _get_reranker()
+    scores = await asyncio.to_thread(model.predict, [(q, p) for p in passages], batch_size=32)
+    best = sorted(range(len(passages)), key=lambda i: scores[i], reverse=True)[:top_k]
+    return [passages[i] for i in best]
+
+
+@tool
+async def digest_search_results(items: List[Tuple[str, List[str]]], max_learn: int = 2, max_follow: int = 2) -> List[SearchDigest]:
+    """
+    Digest the search results of several queries in one structured-output call.
+    Returns one SearchDigest per (query, snippets) item, in the same order;
+    digests are matched to items by id, an item without one gets an empty digest.
+    """
+    entry = f"digest_search_results(items=[{len(items)} queries], max_learn={max_learn}, max_follow={max_follow})"
+    _record_tool(entry)
+    blocks = "\n".join(
+        f"<item id={i}>\nQuery: {q}\n" + "\n".join(f"<content>{s}</content>" for s in snippets) + "\n</item>"
+        for i, (q, snippets) in enumerate(items)
     )
+    prompt = _DIGEST_TMPL.format_map({
+        "max_learn": max_learn,
+        "max_follow": max_follow,
+        "count": len(items),
+        "blocks": blocks,
+    })
 
-    return await llm_complete(
-        system="You're a research analyst. Extract insights and identify knowledge gaps from search results.",
+    batch = await llm_complete(
+        system=_DIGEST_SYS,
         prompt=prompt,
-        schema=SearchDigest
+        schema=DigestBatch,
+        model=DIGEST_MODEL
     )
+    by_id: Dict[int, SearchDigest] = {}
+    for digest in batch.digests:
+        by_id.setdefault(digest.id, digest)
+    return [by_id.get(i) or SearchDigest(learnings=[], follow_up_questions=[]) for i in range(len(items))]
 
 
-async def deep_research(topic: str, breadth: int, depth: int, learnings: List[str] | None = None,
-                        visited: List[str] | None = None) -> Dict:
-    learnings = learnings or []
-    visited = visited or []
+async def deep_research(topic: str, breadth: int, depth: int, learnings: Iterable[str] | None = None,
+                        visited: Iterable[str] | None = None) -> Dict:
+    """
+    Research topic breadth-first, one level at a time. A level's queries are
+    planned and searched as one pipeline, then digested together, so each stage
+    is a batched fan-out instead of a tree of recursive gathers.
+    """
+    all_learnings = set(learnings or ())
+    all_visited = set(visited or ())
+    # each frontier node is (topic, learnings along its path)
+    frontier = [(topic, set(all_learnings))]
+
+    # queries per node at each level, halved (rounding up) every level down
+    schedule = []
+    b = breadth
+    for _ in range(depth):
+        schedule.append(b)
+        b = -(-b // 2)
+
+    for level in range(depth):
+        searched = await _plan_and_search(frontier, schedule[level])
+        found = []
+        for (path, q), results in searched:
+            if isinstance(results, BaseException):
+                e = results
+                if hasattr(e, 'response') and getattr(e.response, 'status_code', None) == 429:
+                    log.warning(f"[Warning] Firecrawl rate limit hit for query '{q.query}'. Skipping.")
+                else:
+                    log.error(f"[Error] Firecrawl failed for '{q.query}': {e}")
+            elif results:
+                found.append((path, q, results))
+
+        digests = await _digest_level([(q.query, [item["markdown"] for item in results]) for _, q, results in found])
+
+        frontier = []
+        for (path, q, results), digest in zip(found, digests):
+            if digest is None:
+                continue
+            urls = [item["url"] for item in results]
+            all_learnings.update(digest.learnings)
+            all_visited.update(urls)
+            next_top = f"{q.research_goal}\n" + "\n".join(digest.follow_up_questions)
+            frontier.append((next_top, path | set(digest.learnings)))
+        if not frontier:
+            break
+
+    return {"learnings": _dedupe_learnings(all_learnings), "visited": list(all_visited)}
 
-    if depth == 0:
-        return {"learnings": learnings, "visited": visited}
 
-    queries = await generate_search_queries(topic, learnings, breadth)
+async def _plan_and_search(frontier: List[Tuple[str, set[str]]], breadth: int) -> List[tuple]:
+    """
+    Generate queries for every frontier node and search them, pipelined: queries
+    are streamed into a queue, and each one that arrives waits up to
+    SEARCH_BATCH_WINDOW for others to share its batch search, so search overlaps
+    with generating the remaining queries.
+    Returns ((path learnings, query), results or exception) pairs.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    # shared by every micro-batch so per-query fallback stays within CONCURRENCY overall
     sem = asyncio.Semaphore(CONCURRENCY)
 
-    async def handle(q: SearchQuery):
-        async with sem:
-            try:
-                results = await firecrawl_search(q.query, k=2)
-                snippets = [item["markdown"] for item in results]
-                urls = [item["url"] for item in results]
-            except Exception as e:
-                if hasattr(e, 'response') and getattr(e.response, 'status_code', None) == 429:
-                    log.warning(f"[Warning] Firecrawl rate limit hit for query '{q.query}'. Skipping.")
-                    return {"learnings": [], "visited": []}
-                log.error(f"[Error] Firecrawl failed for '{q.query}': {e}")
-                return {"learnings": [], "visited": []}
+    async def plan(t: str, path: set[str]) -> None:
+        try:
+            await generate_search_queries(t, path, breadth, on_query=lambda q: queue.put_nowait((path, q)))
+        except Exception as e:
+            log.error(f"[Error] Query generation failed for '{t}': {e}")
+
+    async def plan_all() -> None:
+        await asyncio.gather(*(plan(t, path) for t, path in frontier))
+        queue.put_nowait(None)
+
+    async def search(batch: List[tuple]) -> List[tuple]:
+        results = await firecrawl_search_batch([q.query for _, q in batch], k=2, sem=sem)
+        return list(zip(batch, results))
+
+    loop = asyncio.get_running_loop()
+    planner = asyncio.create_task(plan_all())
+    searches = []
+    done = False
+    while not done:
+        # queries stream in one at a time, collect a window's worth; None marks the end of planning
+        batch = [await queue.get()]
+        deadline = loop.time() + SEARCH_BATCH_WINDOW
+        while batch[-1] is not None and (timeout := deadline - loop.time()) > 0:
             try:
-                digest = await digest_search_result(q.query, snippets, max_learn=2, max_follow=2)
-            except Exception as e:
-                log.error(f"[Error] Digest failed for '{q.query}': {e}")
-                return {"learnings": [], "visited": []}
-            next_top = f"{q.research_goal}\n" + "\n".join(digest.follow_up_questions)
-            return await deep_research(next_top,
-                breadth=math.ceil(breadth/2),
-                depth=depth-1,
-                learnings=learnings + digest.learnings,
-                visited=visited + urls)
-
-    results = await asyncio.gather(*(handle(q) for q in queries))
-    flat_learn = {l for r in results for l in r["learnings"]}
-    flat_urls = {u for r in results for u in r["visited"]}
-    return {"learnings": list(flat_learn), "visited": list(flat_urls)}
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        if batch[-1] is None:
+            done = True
+            batch.pop()
+        if batch:
+            searches.append(asyncio.create_task(search(batch)))
+    await planner
+    return [pair for chunk in await asyncio.gather(*searches) for pair in chunk]
+
+
+async def _digest_level(items: List[Tuple[str, List[str]]]) -> List[SearchDigest | None]:
+    """
+    Digest every searched query of a level in DIGEST_BATCH_SIZE chunks, concurrently.
+    Items whose chunk failed come back as None.
+    """
+    if RERANK:
+        ranked = await asyncio.gather(*(rerank_snippets(query, snippets) for query, snippets in items),
+                                      return_exceptions=True)
+        for i, passages in enumerate(ranked):
+            if isinstance(passages, BaseException):
+                log.error(f"[Error] Rerank failed for '{items[i][0]}', using full snippets: {passages}")
+            else:
+                items[i] = (items[i][0], passages)
+
+    chunks = [items[i:i + DIGEST_BATCH_SIZE] for i in range(0, len(items), DIGEST_BATCH_SIZE)]
+    batches = await asyncio.gather(*(digest_search_results(chunk, max_learn=2, max_follow=2) for chunk in chunks),
+                                   return_exceptions=True)
+    digests: List[SearchDigest | None] = []
+    for chunk, batch in zip(chunks, batches):
+        if isinstance(batch, BaseException):
+            log.error(f"[Error] Digest failed for {[query for query, _ in chunk]}: {batch}")
+            digests += [None] * len(chunk)
+        else:
+            digests += batch
+    return digests
+
+
+async def shutdown() -> None:
+    """
+    Close the running loop's HTTP clients and the disk cache. The disk cache can't
+    be reopened, so only the process that owns the module should call this, at exit.
+    """
+    await embedding_batcher.aclose()
+    await openai_client().close()
+    await firecrawl_http().aclose()
+    disk_cache.close()
 
 if __name__ == "__main__":
-    tiny_agent(tools=[generate_search_queries,
-               firecrawl_search, digest_search_result])
+    tiny_agent(tools=[generate_search_queries, firecrawl_search,
+               firecrawl_search_batch, rerank_snippets, digest_search_results])
     topic = "make a report on the state of ai agents"
-    result = asyncio.run(deep_research(topic, breadth=3, depth=2))
+
+    async def main() -> Dict:
+        try:
+            return await deep_research(topic, breadth=3, depth=2)
+        finally:
+            await shutdown()
+
+    # uvloop is a faster drop-in event loop for this socket-bound workload, optional (no Windows support)
+    try:
+        import uvloop
+        run_loop = uvloop.run
+    except ImportError:
+        run_loop = asyncio.run
+    result = run_loop(main())
     print(result)
 
     # Save the report in src/reports, label by topic
-    import json
-    import re
     reports_dir = os.path.join(os.path.dirname(__file__), "reports")
     os.makedirs(reports_dir, exist_ok=True)
     # Safe filename from topic
     safe_topic = re.sub(r'[^a-zA-Z0-9_-]', '_', topic.lower())[:50]
     report_path = os.path.join(reports_dir, f"{safe_topic}.json")
-    with open(report_path, "w") as f:
-        json.dump(result, f, indent=2)
+    with open(report_path, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
     print(f"Report saved to {report_path}")
 
 # Print the tool usage summary
@@ -0,0 +1,528 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import importlib.util
+
+import httpx
+import numpy as np
+import openai
+import pytest
+
+# src/main.py builds its clients at import, give it dummy keys and a throwaway cache
+os.environ.setdefault("OPENAI_KEY", "test-key")
+os.environ.setdefault("FIRECRAWL_KEY", "test-key")
+os.environ["TINYAGENT_DS_CACHE_DIR"] = tempfile.mkdtemp(prefix="tinyagent_ds_test_")
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+spec = importlib.util.spec_from_file_location("deep_research_main", os.path.join(project_root, "src", "main.py"))
+main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(main)
+
+
+class Obj:
+    """Attribute bag standing in for SDK response objects."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def unit_vec(text: str, dim: int = 8) -> list:
+    rng = np.random.default_rng(int(hashlib.md5(text.encode()).hexdigest()[:8], 16))
+    vec = rng.normal(size=dim)
+    return list(vec / np.linalg.norm(vec))
+
+
+def status_error(status: int, headers: dict | None = None) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://example.test/v1/search")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Every test starts with empty caches and no loop-bound state."""
+    main._llm_cache.clear()
+    main._fc_cache.clear()
+    main._inflight.clear()
+    main.disk_cache.clear()
+    monkeypatch.setattr(main, "semantic_cache", main.SemanticCache())
+    monkeypatch.setattr(main, "embedding_batcher", main.EmbeddingBatcher())
+    monkeypatch.setattr(main, "_loop_state", (None, {}))
+    monkeypatch.setattr(main, "_batch_search_available", True)
+
+
+def stub_embeddings(monkeypatch, create) -> None:
+    """Build every loop's OpenAI client as a stub whose embeddings.create is create."""
+    monkeypatch.setattr(main, "_new_openai_client", lambda: Obj(embeddings=Obj(create=create)))
+
+
+class LoopBoundTransport(httpx.AsyncBaseTransport):
+    """Fails like a pooled connection when used from a loop other than its first."""
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self.inner = inner
+        self.loop = None
+
+    async def handle_async_request(self, request):
+        loop = asyncio.get_running_loop()
+        if self.loop is None:
+            self.loop = loop
+        elif self.loop is not loop:
+            raise RuntimeError("Event loop is closed")
+        return await self.inner.handle_async_request(request)
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    """Stub embeddings.create; records the input list of every request."""
+    calls = []
+
+    async def create(model, input):
+        calls.append(list(input))
+        return Obj(data=[Obj(index=i, embedding=unit_vec(t)) for i, t in enumerate(input)])
+
+    stub_embeddings(monkeypatch, create)
+    return calls
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Record retry sleeps instead of waiting them out."""
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 0.0)
+    return delays
+
+# _memoized
+
+
+def test_memoized_coalesces_concurrent_identical_calls():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    async def scenario():
+        cache = {}
+        results = await asyncio.gather(*(main._memoized(cache, ("key",), fetch) for _ in range(5)))
+        again = await main._memoized(cache, ("key",), fetch)
+        return results, again
+
+    results, again = asyncio.run(scenario())
+    assert calls == 1
+    assert results == [["result"]] * 5
+    assert again == ["result"]
+
+
+def test_memoized_cancelled_caller_does_not_cancel_others():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def scenario():
+        cache = {}
+        first = asyncio.create_task(main._memoized(cache, ("key",), fetch))
+        second = asyncio.create_task(main._memoized(cache, ("key",), fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        return await second, first.cancelled(), cache
+
+    result, first_cancelled, cache = asyncio.run(scenario())
+    assert result == "done"
+    assert first_cancelled
+    assert cache == {("key",): "done"}
+
+
+def test_memoized_does_not_cache_failures():
+    attempts = 0
+
+    async def fetch():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise RuntimeError("boom")
+        return "ok"
+
+    async def scenario():
+        cache = {}
+        with pytest.raises(RuntimeError):
+            await main._memoized(cache, ("key",), fetch)
+        return await main._memoized(cache, ("key",), fetch)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert attempts == 2
+
+# _with_retry
+
+
+def test_with_retry_honors_retry_after(no_sleep):
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise status_error(429, {"retry-after": "1.5"})
+        return "ok"
+
+    assert asyncio.run(main._with_retry(call)) == "ok"
+    assert attempts == 3
+    assert no_sleep == [1.5, 1.5]
+
+
+def test_with_retry_does_not_retry_client_errors(no_sleep):
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        raise status_error(400)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main._with_retry(call))
+    assert attempts == 1
+    assert no_sleep == []
+
+
+def test_with_retry_gives_up_after_max_attempts(no_sleep):
+    async def call():
+        raise status_error(503)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(main._with_retry(call, max_attempts=3))
+    assert len(no_sleep) == 2
+
+def test_with_retry_clamps_retry_after(no_sleep):
+    attempts = 0
+
+    async def call():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 2:
+            raise status_error(429, {"retry-after": "3600"})
+        return "ok"
+
+    assert asyncio.run(main._with_retry(call)) == "ok"
+    assert no_sleep == [main.RETRY_MAX_DELAY]
+
+# _plan_and_search
+
+
+def test_plan_and_search_starts_searching_before_planning_finishes(monkeypatch):
+    monkeypatch.setattr(main, "SEARCH_BATCH_WINDOW", 0.001)
+    events = []
+
+    async def fake_generate(topic, prev_learnings, n=3, on_query=None):
+        queries = [main.SearchQuery(query=f"{topic}-q{i}", research_goal="goal") for i in range(n)]
+        for q in queries:
+            await asyncio.sleep(0.01)
+            on_query(q)
+        events.append(f"planned {topic}")
+        return queries
+
+    async def fake_search_batch(qs, k=2, sem=None):
+        events.append(f"search {len(qs)}")
+        return [[{"url": f"https://example.test/{q}", "markdown": q}] for q in qs]
+
+    monkeypatch.setattr(main, "generate_search_queries", fake_generate)
+    monkeypatch.setattr(main, "firecrawl_search_batch", fake_search_batch)
+
+    frontier = [("a", {"la"}), ("b", {"lb"})]
+    searched = asyncio.run(main._plan_and_search(frontier, 2))
+
+    pairs = {q.query: (path, results) for (path, q), results in searched}
+    assert set(pairs) == {"a-q0", "a-q1", "b-q0", "b-q1"}
+    assert pairs["a-q1"][0] == {"la"}
+    assert pairs["b-q0"][0] == {"lb"}
+    assert pairs["b-q0"][1] == [{"url": "https://example.test/b-q0", "markdown": "b-q0"}]
+    assert events[0].startswith("search")
+
+def test_plan_and_search_coalesces_streamed_queries(monkeypatch):
+    batch_sizes = []
+
+    async def fake_generate(topic, prev_learnings, n=3, on_query=None):
+        queries = [main.SearchQuery(query=f"{topic}-q{i}", research_goal="goal") for i in range(n)]
+        for q in queries:
+            # queries arrive one by one, a few ms apart, as they do when streamed
+            await asyncio.sleep(0.005)
+            on_query(q)
+        return queries
+
+    async def fake_search_batch(qs, k=2, sem=None):
+        batch_sizes.append(len(qs))
+        return [[hit(q)] for q in qs]
+
+    monkeypatch.setattr(main, "generate_search_queries", fake_generate)
+    monkeypatch.setattr(main, "firecrawl_search_batch", fake_search_batch)
+
+    searched = asyncio.run(main._plan_and_search([("a", set())], 3))
+    assert len(searched) == 3
+    assert batch_sizes == [3]
+
+# semantic cache
+
+
+@pytest.fixture
+def llm_calls(monkeypatch):
+    """Stub the model request; answers echo the prompt and record every call."""
+    calls = []
+
+    async def fake_request(system, prompt, schema, model, on_partial=None):
+        calls.append(prompt)
+        if schema is main.SearchBatch:
+            return main.SearchBatch(queries=[main.SearchQuery(query=prompt[-40:], research_goal="goal")])
+        return schema.model_validate({"digests": []})
+
+    monkeypatch.setattr(main, "_llm_request", fake_request)
+    return calls
+
+
+def test_semantic_cache_is_skipped_for_digests(embeddings, llm_calls):
+    async def scenario():
+        for i in range(2):
+            await main.llm_complete("sys", f"results {i}", main.DigestBatch)
+
+    asyncio.run(scenario())
+    assert embeddings == []
+    assert len(llm_calls) == 2
+
+
+def test_semantic_cache_keys_plans_by_topic_count_and_findings(embeddings, llm_calls):
+    async def scenario():
+        await main.generate_search_queries("topic a", ["shared finding"], n=2)
+        await main.generate_search_queries("topic b", ["shared finding"], n=2)
+        # same topic, different count: must not be served the two-query plan
+        await main.generate_search_queries("topic a", ["shared finding"], n=3)
+
+    asyncio.run(scenario())
+    assert [t for batch in embeddings for t in batch] == ["topic a", "topic b", "topic a"]
+    assert len(llm_calls) == 3
+
+
+def test_embedding_failure_falls_through_to_llm(monkeypatch, llm_calls):
+    async def create(model, input):
+        raise status_error(400)
+
+    stub_embeddings(monkeypatch, create)
+    queries = asyncio.run(main.generate_search_queries("topic", [], n=1))
+    assert len(queries) == 1
+    assert len(llm_calls) == 1
+
+
+def test_embed_sends_a_bounded_prefix(embeddings):
+    asyncio.run(main.embed("x" * (main.EMBED_MAX_CHARS * 3)))
+    assert embeddings == [["x" * main.EMBED_MAX_CHARS]]
+
+def test_llm_complete_documents_the_semantic_option():
+    assert "semantic=(scope, text)" in main.llm_complete.__doc__
+
+
+def test_semantic_cache_grows_small_buckets():
+    cache = main.SemanticCache(initial_capacity=2)
+    vecs = [np.asarray(unit_vec(f"prompt {i}"), dtype=np.float32) for i in range(5)]
+    for i, vec in enumerate(vecs):
+        cache.put(("bucket",), vec, {"i": i})
+
+    assert cache._indexes[("bucket",)].get_max_elements() == 8
+    assert [cache.get(("bucket",), vec) for vec in vecs] == [{"i": i} for i in range(5)]
+
+# firecrawl_search_batch
+
+
+def hit(query: str) -> dict:
+    return {"url": f"https://example.test/{query}", "markdown": query}
+
+
+def mock_firecrawl(monkeypatch, batch_body: bytes | None = None) -> list:
+    """
+    Route firecrawl_http through a loop-bound MockTransport; returns the list of
+    requested paths. Batch search answers with batch_body, or properly if it is None.
+    """
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        payload = main.orjson.loads(request.content)
+        if request.url.path == "/v1/batch/search":
+            if batch_body is None:
+                return httpx.Response(200, json={"data": [[hit(q)] for q in payload["queries"]]})
+            return httpx.Response(200, content=batch_body)
+        return httpx.Response(200, json={"data": [hit(payload["query"])]})
+
+    monkeypatch.setattr(main, "_new_firecrawl_http", lambda: httpx.AsyncClient(
+        base_url="https://firecrawl.test", transport=LoopBoundTransport(httpx.MockTransport(handler))))
+    return paths
+
+
+@pytest.mark.parametrize("body", [
+    b'{"data": {"results": []}}',
+    b'[{"url": "https://example.test/x", "markdown": "x"}]',
+    b'{"data": [[{"url": "https://example.test/x", "markdown": "x"}]]}',
+    b'not json',
+])
+def test_search_batch_falls_back_on_unexpected_body(monkeypatch, body):
+    paths = mock_firecrawl(monkeypatch, body)
+    results = asyncio.run(main.firecrawl_search_batch(["q1", "q2"], k=2))
+
+    assert results == [[{"markdown": "q1", "url": "https://example.test/q1"}],
+                       [{"markdown": "q2", "url": "https://example.test/q2"}]]
+    assert paths.count("/v1/batch/search") == 1
+    assert paths.count("/v1/search") == 2
+    assert main._batch_search_available is False
+
+
+def test_search_fallback_works_in_every_event_loop(monkeypatch):
+    # CONCURRENCY < 5 makes queries wait on the semaphore, which binds it to the loop
+    monkeypatch.setattr(main, "_batch_search_available", False)
+    paths = mock_firecrawl(monkeypatch)
+    for run in ("first", "second"):
+        qs = [f"{run}-{i}" for i in range(5)]
+        results = asyncio.run(main.firecrawl_search_batch(qs, k=2))
+        assert results == [[{"markdown": q, "url": f"https://example.test/{q}"}] for q in qs]
+    assert paths == ["/v1/search"] * 10
+
+
+def test_search_batch_uses_batch_results(monkeypatch):
+    body = main.orjson.dumps({"data": [[{"url": f"https://example.test/{q}", "markdown": q}] for q in ("q1", "q2")]})
+    paths = mock_firecrawl(monkeypatch, body)
+    results = asyncio.run(main.firecrawl_search_batch(["q1", "q2"], k=2))
+
+    assert results[1] == [{"markdown": "q2", "url": "https://example.test/q2"}]
+    assert paths == ["/v1/batch/search"]
+
+# digest_search_results
+
+
+def test_digests_are_matched_to_items_by_id(monkeypatch):
+    async def fake_complete(system, prompt, schema, model=None, **kwargs):
+        # out of order, a duplicate and an unknown id, and item 1 missing
+        return main.DigestBatch(digests=[
+            main.ItemDigest(id=2, learnings=["about c"], follow_up_questions=[]),
+            main.ItemDigest(id=0, learnings=["about a"], follow_up_questions=["more a?"]),
+            main.ItemDigest(id=0, learnings=["stray"], follow_up_questions=[]),
+            main.ItemDigest(id=7, learnings=["unknown"], follow_up_questions=[]),
+        ])
+
+    monkeypatch.setattr(main, "llm_complete", fake_complete)
+    items = [("a", ["snippet a"]), ("b", ["snippet b"]), ("c", ["snippet c"])]
+    digests = asyncio.run(main.digest_search_results(items))
+
+    assert [d.learnings for d in digests] == [["about a"], [], ["about c"]]
+    assert digests[0].follow_up_questions == ["more a?"]
+
+# deep_research
+
+
+def test_deep_research_searches_in_every_event_loop(monkeypatch):
+    async def fake_generate(topic, prev_learnings, n=3, on_query=None):
+        queries = [main.SearchQuery(query=f"{topic}-q{i}", research_goal="goal") for i in range(n)]
+        for q in queries:
+            on_query(q)
+        return queries
+
+    async def fake_digest(items, max_learn=2, max_follow=2):
+        return [main.SearchDigest(learnings=[f"learned {q}"], follow_up_questions=[]) for q, _ in items]
+
+    monkeypatch.setattr(main, "generate_search_queries", fake_generate)
+    monkeypatch.setattr(main, "digest_search_results", fake_digest)
+    paths = mock_firecrawl(monkeypatch)
+
+    first = asyncio.run(main.deep_research("first", breadth=2, depth=1))
+    second = asyncio.run(main.deep_research("second", breadth=2, depth=1))
+
+    assert sorted(first["visited"]) == ["https://example.test/first-q0", "https://example.test/first-q1"]
+    assert sorted(second["visited"]) == ["https://example.test/second-q0", "https://example.test/second-q1"]
+    assert len(paths) >= 2
+
+# EmbeddingBatcher
+
+
+def test_embedding_batcher_coalesces_concurrent_prompts(embeddings):
+    async def scenario():
+        return await asyncio.gather(*(main.embed(f"prompt {i}") for i in range(5)))
+
+    vecs = asyncio.run(scenario())
+    assert embeddings == [[f"prompt {i}" for i in range(5)]]
+    for i, vec in enumerate(vecs):
+        assert np.allclose(vec, unit_vec(f"prompt {i}"), atol=1e-6)
+
+
+def test_embedding_batcher_isolates_a_failing_prompt(monkeypatch):
+    calls = []
+
+    async def create(model, input):
+        calls.append(list(input))
+        if "bad" in input:
+            request = httpx.Request("POST", "https://example.test/v1/embeddings")
+            raise openai.BadRequestError("too long", response=httpx.Response(400, request=request), body=None)
+        return Obj(data=[Obj(index=i, embedding=unit_vec(t)) for i, t in enumerate(input)])
+
+    stub_embeddings(monkeypatch, create)
+
+    async def scenario():
+        return await asyncio.gather(*(main.embed(t) for t in ["a", "bad", "c", "d"]), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert isinstance(results[1], openai.BadRequestError)
+    for text, vec in zip("acd", [results[0], results[2], results[3]]):
+        assert np.allclose(vec, unit_vec(text), atol=1e-6)
+    assert calls[0] == ["a", "bad", "c", "d"]
+
+
+def test_embedding_batcher_does_not_split_on_batch_wide_errors(monkeypatch):
+    calls = []
+
+    async def create(model, input):
+        calls.append(list(input))
+        request = httpx.Request("POST", "https://example.test/v1/embeddings")
+        raise openai.AuthenticationError("bad key", response=httpx.Response(401, request=request), body=None)
+
+    stub_embeddings(monkeypatch, create)
+
+    async def scenario():
+        return await asyncio.gather(*(main.embed(f"prompt {i}") for i in range(32)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, openai.AuthenticationError) for r in results)
+    assert len(calls) == 1
+
+
+def test_embedding_batcher_caps_characters_per_request(monkeypatch, embeddings):
+    monkeypatch.setattr(main, "embedding_batcher", main.EmbeddingBatcher(max_chars=10))
+
+    async def scenario():
+        await asyncio.gather(*(main.embed(t) for t in ["aaaa", "bbbb", "cccc", "dddddddddddd"]))
+
+    asyncio.run(scenario())
+    assert embeddings == [["aaaa", "bbbb"], ["cccc"], ["dddddddddddd"]]
+
+# tokenizer loading
+
+
+def test_get_encoding_falls_back_when_tokenizer_cannot_load(monkeypatch):
+    def offline(*args, **kwargs):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(main.tiktoken, "encoding_for_model", offline)
+    monkeypatch.setattr(main.tiktoken, "get_encoding", offline)
+    main._get_encoding.cache_clear()
+    try:
+        assert main._get_encoding() is None
+    finally:
+        main._get_encoding.cache_clear()
+
+
+def test_clip_markdown_cuts_by_characters_without_tokenizer(monkeypatch):
+    monkeypatch.setattr(main, "_get_encoding", lambda: None)
+    text = "word " * (main.MAX_TOKENS_PER_DOC * 2)
+    clipped = main._clip_markdown(text)
+    assert len(clipped) == main.MAX_TOKENS_PER_DOC * main.CHARS_PER_TOKEN
+    assert main._passages("x" * (main.PASSAGE_TOKENS * main.CHARS_PER_TOKEN + 1))[-1] == "x"